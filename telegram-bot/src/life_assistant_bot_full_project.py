@@ -1,11 +1,27 @@
+import asyncio
+import base64
+import heapq
+import importlib.util
+import json
 import logging
+import queue
+import re
 import sys
 import os
 import sqlite3
-from datetime import datetime, timedelta
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
 from decimal import Decimal, InvalidOperation
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Iterator
 
+import httpx
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -13,293 +29,1273 @@ from telegram.ext import (
     ContextTypes, filters
 )
 
+# orjson быстрее stdlib json; без него платёжный код работает на json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # ---------- Настройка окружения и логов ----------
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 ADMIN_ID = int(os.getenv('ADMIN_ID')) if os.getenv('ADMIN_ID') else None
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 TRIAL_DAYS = int(os.getenv('TRIAL_DAYS', '30'))
+SUBSCRIPTION_DAYS = int(os.getenv('SUBSCRIPTION_DAYS', '30'))
+SUBSCRIPTION_PRICE_RUB = int(os.getenv('SUBSCRIPTION_PRICE_RUB', '500'))
+# если задан домен — работаем через webhook, иначе через polling
+WEBHOOK_DOMAIN = os.getenv('WEBHOOK_DOMAIN')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# ЮKassa: без ключей бот выдаёт тестовую ссылку
+YOOKASSA_SHOP_ID = os.getenv('YOOKASSA_SHOP_ID')
+YOOKASSA_SECRET_KEY = os.getenv('YOOKASSA_SECRET_KEY')
+YOOKASSA_RETURN_URL = os.getenv('YOOKASSA_RETURN_URL', 'https://t.me')
+
+# запись в stdout выполняет фоновый поток слушателя, обработчики только кладут запись в очередь
+_log_queue = queue.SimpleQueue()
+_stdout_handler = logging.StreamHandler(sys.stdout)
+_stdout_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = QueueListener(_log_queue, _stdout_handler, respect_handler_level=True)
+log_listener.start()
 
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
+    format='%(message)s',
+    handlers=[QueueHandler(_log_queue)]
 )
 logger = logging.getLogger(__name__)
+# httpx пишет INFO на каждый запрос — при long polling и платежах это строка журнала на каждый вызов API
+logging.getLogger('httpx').setLevel(logging.WARNING)
 
 if not TELEGRAM_TOKEN:
     logger.error('TELEGRAM_TOKEN не задан в .env. Останов.')
+    log_listener.stop()
     sys.exit(1)
 
 # ---------- Примитивная БД (sqlite) ----------
+SCHEMA_SQL = '''
+-- users: id, username, first_name, last_name, trial_used, subscription_end_ts
+-- моменты времени, которые сравниваются и сортируются, храним INTEGER-секундами эпохи (UTC)
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    trial_used INTEGER DEFAULT 0,
+    subscription_end_ts INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS reminders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    chat_id INTEGER,
+    text TEXT,
+    due_ts INTEGER,
+    completed INTEGER DEFAULT 0,
+    created_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    amount_kopeks INTEGER,
+    category TEXT,
+    description TEXT,
+    type TEXT,
+    created_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS chat_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    chat_id INTEGER,
+    message TEXT,
+    message_low TEXT,
+    created_at TEXT
+);
+
+-- итоги по пользователю в копейках; обновляются в одной транзакции с добавлением операций
+CREATE TABLE IF NOT EXISTS user_totals (
+    user_id INTEGER PRIMARY KEY,
+    income INTEGER NOT NULL DEFAULT 0,
+    expense INTEGER NOT NULL DEFAULT 0
+);
+
+-- зачтённые платежи ЮKassa: первичный ключ не даёт продлить подписку по одному платежу дважды
+CREATE TABLE IF NOT EXISTS payments (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    credited_at TEXT
+) WITHOUT ROWID;
+
+-- счётчики для панели администратора: чтение одной строки вместо COUNT(*) по всей таблице
+CREATE TABLE IF NOT EXISTS stats (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- UPSERT с конфликтом по id выполняет UPDATE и INSERT-триггер не вызывает
+CREATE TRIGGER IF NOT EXISTS users_ai AFTER INSERT ON users
+BEGIN
+    UPDATE stats SET value = value + 1 WHERE key = 'total_users';
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_ad AFTER DELETE ON users
+BEGIN
+    UPDATE stats SET value = value - 1 WHERE key = 'total_users';
+END;
+'''
+
+# индексы создаём после миграции колонок: на старой базе их столбцов ещё может не быть
+SCHEMA_INDEXES_SQL = '''
+-- индексы под выборки по пользователю; rowid входит в индекс неявно,
+-- поэтому ORDER BY id DESC в подсчёте настроения тоже обслуживается индексом
+CREATE INDEX IF NOT EXISTS idx_chat_logs_user ON chat_logs(user_id);
+CREATE INDEX IF NOT EXISTS idx_transactions_user_type ON transactions(user_id, type);
+-- активные подписки считаются диапазонным сканом индекса, без чтения строк таблицы
+CREATE INDEX IF NOT EXISTS idx_users_subscription_end ON users(subscription_end_ts);
+CREATE INDEX IF NOT EXISTS idx_reminders_user_due ON reminders(user_id, due_ts);
+-- частичный индекс: только невыполненные напоминания, которые восстанавливаются при старте
+CREATE INDEX IF NOT EXISTS idx_reminders_pending ON reminders(due_ts) WHERE completed = 0;
+'''
+
+# текст горячих INSERT-ов неизменен, поэтому sqlite3 берёт уже разобранное выражение из кэша соединения
+SQL_INSERT_REMINDER = 'INSERT INTO reminders (user_id, chat_id, text, due_ts, created_at) VALUES (?, ?, ?, ?, ?)'
+SQL_INSERT_TX = 'INSERT INTO transactions (user_id, amount_kopeks, category, description, type, created_at) VALUES (?, ?, ?, ?, ?, ?)'
+SQL_INSERT_CHAT_LOG = 'INSERT INTO chat_logs (user_id, chat_id, message, message_low, created_at) VALUES (?, ?, ?, ?, ?)'
+# id самого старого из оставляемых сообщений находится по idx_chat_logs_user; если сообщений меньше — NULL и ничего не удаляется
+SQL_TRIM_CHAT_LOGS = '''DELETE FROM chat_logs WHERE user_id = ? AND id < (
+                            SELECT id FROM chat_logs WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)'''
+SQL_ADD_USER_TOTALS = '''INSERT INTO user_totals (user_id, income, expense) VALUES (?, ?, ?)
+                         ON CONFLICT(user_id) DO UPDATE SET income = income + excluded.income,
+                                                            expense = expense + excluded.expense'''
+# запросы напоминаний: один текст на запрос, без ветвлений в методах
+SQL_REMINDERS_FOR_DISPLAY = 'SELECT completed, text, due_ts FROM reminders WHERE user_id = ? ORDER BY due_ts'
+SQL_PENDING_REMINDERS_BETWEEN = '''SELECT due_ts, id FROM reminders
+                                   WHERE completed = 0 AND due_ts >= ? AND due_ts < ? ORDER BY due_ts'''
+SQL_CLAIM_REMINDERS = '''UPDATE reminders SET completed = 1
+                         WHERE completed = 0 AND id IN (SELECT value FROM json_each(?))
+                         RETURNING id, user_id, chat_id, text'''
+SQL_CLAIM_OVERDUE_REMINDERS = '''UPDATE reminders SET completed = 1 WHERE completed = 0 AND due_ts < ?
+                                 RETURNING id, user_id, chat_id, text'''
+SQL_RELEASE_REMINDER = 'UPDATE reminders SET completed = 0 WHERE id = ?'
+
+
+def _to_kopeks(amount) -> Optional[int]:
+    # суммы храним целыми копейками: встроенный SUM по INTEGER точен и не требует CAST
+    try:
+        return int((Decimal(amount) * 100).quantize(Decimal('1')))
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+
+
+# Запрос, текст которого зависит только от количества параметров, собираем один раз на каждую форму
+@lru_cache(maxsize=None)
+def _mood_counts_sql(positive: int, negative: int) -> str:
+    has_positive = ' OR '.join(['instr(m, ?) > 0'] * positive)
+    has_negative = ' OR '.join(['instr(m, ?) > 0'] * negative)
+    return f'''
+    SELECT COUNT(*) AS total,
+           COALESCE(SUM({has_positive}), 0) AS positive,
+           COALESCE(SUM({has_negative}), 0) AS negative
+    FROM (SELECT message_low AS m FROM chat_logs WHERE user_id = ? ORDER BY id DESC LIMIT ?)
+    '''
+
+
+# настроение и финансовые итоги за один запрос: CTE с подсчётом настроения и строка user_totals
+@lru_cache(maxsize=None)
+def _analytics_sql(positive: int, negative: int) -> str:
+    return f'''
+    WITH mood AS ({_mood_counts_sql(positive, negative)}),
+         totals AS (SELECT income, expense FROM user_totals WHERE user_id = ?)
+    SELECT mood.total, mood.positive, mood.negative,
+           COALESCE(totals.income, 0) AS income, COALESCE(totals.expense, 0) AS expense
+    FROM mood LEFT JOIN totals ON 1
+    '''
+
+
+def _classify_mood(positive: int, negative: int) -> str:
+    if positive > negative:
+        return 'positive'
+    if negative > positive:
+        return 'negative'
+    return 'neutral'
+
+
+@dataclass(frozen=True)
+class AnalyticsBundle:
+    # поля совпадают с подстановками шаблонов аналитики
+    total_messages: int
+    positive: int
+    negative: int
+    mood: str
+    income: int   # копейки
+    expense: int
+    balance: int
+
+
 class Database:
+    POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+    POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))  # читатели, открываемые заранее
+    SUBSCRIPTION_CACHE_TTL = 60  # сек
+    SUBSCRIPTION_CACHE_SIZE = 10000
+    STATEMENT_CACHE_SIZE = 256  # подготовленных выражений на соединение
+
     def __init__(self, path: str = 'bot_data.db'):
         self.path = path
-        self.conn = sqlite3.connect(self.path, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
+        # один писатель на всё приложение: SQLite всё равно допускает только одну пишущую транзакцию
+        self._writer = self._connect()
+        self._write_lock = threading.RLock()
+        self._tx_depth = 0  # вложенность transaction() в потоке, держащем _write_lock
+        # читатели — отдельные read-only соединения: в WAL они не ждут писателя и не делят с ним курсор
+        self._pool = queue.LifoQueue()
+        self._pool_lock = threading.Lock()
+        self._opened = 0
+        # user_id -> (окончание подписки в секундах эпохи, monotonic-время проверки)
+        self._sub_cache: 'OrderedDict[int, tuple]' = OrderedDict()
+        self._sub_cache_lock = threading.Lock()
+        # растёт при каждом сбросе записи: проверка, начатая до сброса, не кладёт в кэш прочитанное ею старое значение
+        self._sub_cache_epoch = 0
         self._migrate()
-
-    def _migrate(self):
-        cur = self.conn.cursor()
-        # users: id, username, first_name, last_name, trial_used, subscription_end
-        cur.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            trial_used INTEGER DEFAULT 0,
-            subscription_end TEXT
-        )
+        # прогреваем пул после миграции (read-only соединению нужен уже созданный файл БД):
+        # первые запросы не платят за открытие соединения и PRAGMA
+        for _ in range(min(self.POOL_MIN_SIZE, self.POOL_SIZE)):
+            self._opened += 1
+            self._pool.put(self._connect(read_only=True))
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        # sqlite3 держит на соединении LRU подготовленных выражений по тексту SQL: повторный execute с тем же
+        # текстом не разбирает и не планирует запрос заново. Запас по размеру, чтобы все запросы бота
+        # (включая варианты _mood_counts_sql) не вытесняли друг друга
+        if read_only:
+            conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False,
+                                   cached_statements=self.STATEMENT_CACHE_SIZE)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=self.STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        # WAL: читатели не блокируют писателя и друг друга; NORMAL — без fsync на каждый commit;
+        # кэш страниц 64 МБ и mmap держат горячие данные в памяти; busy_timeout ждёт блокировку вместо ошибки
+        conn.executescript('''
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-64000;
+            PRAGMA mmap_size=268435456;
+            PRAGMA busy_timeout=30000;
         ''')
+        return conn
 
-        cur.execute('''
-        CREATE TABLE IF NOT EXISTS reminders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            chat_id INTEGER,
-            text TEXT,
-            due_date TEXT,
-            completed INTEGER DEFAULT 0,
-            created_at TEXT
-        )
-        ''')
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._pool_lock:
+            if self._opened < self.POOL_SIZE:
+                self._opened += 1
+                return self._connect(read_only=True)
+        # пул исчерпан — ждём, пока кто-нибудь вернёт соединение
+        return self._pool.get()
+
+    @contextmanager
+    def acquire_reader(self) -> Iterator[sqlite3.Connection]:
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        # BEGIN IMMEDIATE берёт блокировку записи сразу, а не при первом UPDATE;
+        # вложенные вызовы (в т.ч. методы Database внутри transaction()) работают в той же транзакции,
+        # поэтому несколько записей укладываются в один commit
+        with self._write_lock:
+            if self._tx_depth:
+                self._tx_depth += 1
+                try:
+                    yield self._writer
+                finally:
+                    self._tx_depth -= 1
+                return
+            self._writer.execute('BEGIN IMMEDIATE')
+            self._tx_depth = 1
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.rollback()
+                raise
+            else:
+                self._writer.commit()
+            finally:
+                self._tx_depth = 0
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        # commit при успехе, rollback при исключении
+        with self.transaction() as conn:
+            yield conn
+
+    def close(self):
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._pool_lock:
+                self._opened -= 1
+        with self._write_lock:
+            # обновляем статистику планировщика по накопленным за сеанс запросам
+            self._writer.execute('PRAGMA optimize')
+            self._writer.close()
 
-        cur.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            amount TEXT,
-            category TEXT,
-            description TEXT,
-            type TEXT,
-            created_at TEXT
-        )
-        ''')
+    def _migrate(self):
+        with self.connection() as conn:
+            # вся схема — один executescript вместо отдельного вызова на каждую таблицу и индекс
+            conn.executescript(SCHEMA_SQL)
+            cur = conn.cursor()
+            # счётчик заводится один раз; дальше его поддерживают триггеры
+            cur.execute("INSERT OR IGNORE INTO stats (key, value) SELECT 'total_users', COUNT(*) FROM users")
+            if self._add_missing_column(cur, 'chat_logs', 'message_low', 'TEXT'):
+                # встроенный lower() в SQLite понимает только ASCII, поэтому заполняем средствами Python
+                cur.execute('SELECT id, message FROM chat_logs')
+                cur.executemany('UPDATE chat_logs SET message_low = ? WHERE id = ?',
+                                [((row['message'] or '').lower(), row['id']) for row in cur.fetchall()])
+            if self._add_missing_column(cur, 'transactions', 'amount_kopeks', 'INTEGER'):
+                # старые суммы лежали строками Decimal в amount — переводим их в копейки один раз
+                cur.execute('SELECT id, amount FROM transactions')
+                cur.executemany('UPDATE transactions SET amount_kopeks = ? WHERE id = ?',
+                                [(_to_kopeks(row['amount']), row['id']) for row in cur.fetchall()])
+            if not cur.execute('SELECT 1 FROM user_totals LIMIT 1').fetchone():
+                # итоги заводятся один раз по накопленной истории; дальше их ведёт add_transactions_bulk
+                cur.execute('''INSERT INTO user_totals (user_id, income, expense)
+                               SELECT user_id,
+                                      COALESCE(SUM(CASE WHEN type = 'income' THEN amount_kopeks END), 0),
+                                      COALESCE(SUM(CASE WHEN type = 'income' THEN NULL ELSE amount_kopeks END), 0)
+                               FROM transactions GROUP BY user_id''')
+            # ISO-строки сроков переводим в секунды эпохи; старые индексы по строковым столбцам удаляем
+            if self._add_missing_column(cur, 'users', 'subscription_end_ts', 'INTEGER'):
+                cur.execute("UPDATE users SET subscription_end_ts = CAST(strftime('%s', subscription_end) AS INTEGER)")
+                self._drop_column(cur, 'users', 'subscription_end')
+            if self._add_missing_column(cur, 'reminders', 'due_ts', 'INTEGER'):
+                cur.execute("UPDATE reminders SET due_ts = CAST(strftime('%s', due_date) AS INTEGER)")
+                cur.execute('DROP INDEX IF EXISTS idx_reminders_user_due')
+                cur.execute('DROP INDEX IF EXISTS idx_reminders_pending')
+                self._drop_column(cur, 'reminders', 'due_date')
+            conn.executescript(SCHEMA_INDEXES_SQL)
+
+    def _add_missing_column(self, cur: sqlite3.Cursor, table: str, column: str, decl: str) -> bool:
+        cur.execute(f'PRAGMA table_info({table})')
+        if any(row['name'] == column for row in cur.fetchall()):
+            return False
+        cur.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+        return True
 
-        self.conn.commit()
+    def _drop_column(self, cur: sqlite3.Cursor, table: str, column: str):
+        # DROP COLUMN появился в SQLite 3.35; на более старых версиях столбец просто остаётся неиспользуемым
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            cur.execute(f'ALTER TABLE {table} DROP COLUMN {column}')
 
     def add_user(self, user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str]):
-        cur = self.conn.cursor()
-        cur.execute('SELECT id FROM users WHERE id = ?', (user_id,))
-        if cur.fetchone():
-            # обновим данные
-            cur.execute('UPDATE users SET username=?, first_name=?, last_name=? WHERE id=?',
-                        (username, first_name, last_name, user_id))
-        else:
-            cur.execute('INSERT INTO users (id, username, first_name, last_name) VALUES (?, ?, ?, ?)',
+        with self.connection() as conn:
+            cur = conn.cursor()
+            # новый пользователь или обновление данных существующего — одной командой, без предварительного SELECT
+            cur.execute('''INSERT INTO users (id, username, first_name, last_name) VALUES (?, ?, ?, ?)
+                           ON CONFLICT(id) DO UPDATE SET username = excluded.username,
+                                                         first_name = excluded.first_name,
+                                                         last_name = excluded.last_name''',
                         (user_id, username, first_name, last_name))
-        self.conn.commit()
 
     def get_user(self, user_id: int) -> Optional[sqlite3.Row]:
-        cur = self.conn.cursor()
-        cur.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-        return cur.fetchone()
-
-    def set_trial_used(self, user_id: int):
-        cur = self.conn.cursor()
-        cur.execute('UPDATE users SET trial_used = 1 WHERE id = ?', (user_id,))
-        self.conn.commit()
-
-    def check_trial_used(self, user_id: int) -> bool:
-        cur = self.conn.cursor()
-        cur.execute('SELECT trial_used FROM users WHERE id = ?', (user_id,))
-        row = cur.fetchone()
-        return bool(row and row['trial_used'])
+        with self.acquire_reader() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT * FROM users WHERE id = ?', (user_id,))
+            return cur.fetchone()
+
+    def count_users(self) -> int:
+        with self.acquire_reader() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT value FROM stats WHERE key = 'total_users'")
+            row = cur.fetchone()
+        return row['value'] if row else 0
+
+    def count_active_subscriptions(self) -> int:
+        with self.acquire_reader() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT COUNT(*) AS count FROM users WHERE subscription_end_ts > ?', (int(time.time()),))
+            return cur.fetchone()['count']
 
     def update_subscription(self, user_id: int, days: int):
-        end = datetime.utcnow() + timedelta(days=days)
-        end_iso = end.replace(microsecond=0).isoformat()
-        cur = self.conn.cursor()
-        cur.execute('UPDATE users SET subscription_end = ? WHERE id = ?', (end_iso, user_id))
-        # если пользователь не существует — создадим
-        if cur.rowcount == 0:
-            cur.execute('INSERT INTO users (id, subscription_end) VALUES (?, ?)', (user_id, end_iso))
-        self.conn.commit()
+        # продлеваем от текущего окончания, если подписка ещё действует, иначе — от сейчас
+        now_ts = int(time.time())
+        with self.connection() as conn:
+            cur = conn.cursor()
+            # если пользователя ещё нет — создадим его одной и той же командой
+            cur.execute('''INSERT INTO users (id, subscription_end_ts) VALUES (?, ?)
+                           ON CONFLICT(id) DO UPDATE SET
+                               subscription_end_ts = MAX(COALESCE(users.subscription_end_ts, 0), ?) + ?''',
+                        (user_id, now_ts + days * 86400, now_ts, days * 86400))
+        self._invalidate_subscription(user_id)
+
+    def credit_payment(self, payment_id: str, user_id: int, days: int) -> bool:
+        # отметка платежа и продление — одна транзакция; False — платёж уже был зачтён
+        now = datetime.utcnow().replace(microsecond=0).isoformat()
+        with self.transaction() as conn:
+            cur = conn.cursor()
+            cur.execute('INSERT INTO payments (id, user_id, credited_at) VALUES (?, ?, ?) ON CONFLICT(id) DO NOTHING',
+                        (payment_id, user_id, now))
+            if cur.rowcount == 0:
+                return False
+            self.update_subscription(user_id, days)
+        # внутри внешней транзакции сброс в update_subscription произошёл до commit — повторяем после
+        self._invalidate_subscription(user_id)
+        return True
+
+    def get_subscription_end(self, user_id: int) -> int:
+        return self._query_subscription(user_id)
+
+    def claim_trial(self, user_id: int, days: int) -> Optional[int]:
+        # проверка trial_used, продление и отметка — одна команда и один commit;
+        # если пробный период уже был, WHERE не пропустит обновление и RETURNING ничего не вернёт
+        end_ts = int(time.time()) + days * 86400
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('''INSERT INTO users (id, trial_used, subscription_end_ts) VALUES (?, 1, ?)
+                           ON CONFLICT(id) DO UPDATE SET subscription_end_ts = excluded.subscription_end_ts, trial_used = 1
+                           WHERE users.trial_used = 0
+                           RETURNING subscription_end_ts''',
+                        (user_id, end_ts))
+            rows = cur.fetchall()
+        if not rows:
+            return None
+        self._invalidate_subscription(user_id)
+        return rows[0]['subscription_end_ts']
+
+    def _invalidate_subscription(self, user_id: int):
+        with self._sub_cache_lock:
+            self._sub_cache.pop(user_id, None)
+            self._sub_cache_epoch += 1
 
     def check_subscription(self, user_id: int) -> bool:
-        cur = self.conn.cursor()
-        cur.execute('SELECT subscription_end FROM users WHERE id = ?', (user_id,))
-        row = cur.fetchone()
-        if not row or not row['subscription_end']:
-            return False
-        try:
-            end = datetime.fromisoformat(row['subscription_end'])
-            return end > datetime.utcnow()
-        except Exception:
-            return False
+        # администратору доступ открыт всегда — без запроса к БД
+        if user_id == ADMIN_ID:
+            return True
+        now = time.monotonic()
+        with self._sub_cache_lock:
+            cached = self._sub_cache.get(user_id)
+            if cached and now < cached[1] + self.SUBSCRIPTION_CACHE_TTL:
+                self._sub_cache.move_to_end(user_id)
+                # храним момент окончания, а не флаг: подписка, истёкшая внутри TTL, не продлевается кэшем
+                return time.time() < cached[0]
+            epoch = self._sub_cache_epoch
+        expiry = self._query_subscription(user_id)
+        with self._sub_cache_lock:
+            if epoch != self._sub_cache_epoch:
+                # пока шёл запрос, подписку меняли: прочитанное могло устареть, в кэш не кладём
+                return time.time() < expiry
+            self._sub_cache[user_id] = (expiry, now)
+            self._sub_cache.move_to_end(user_id)
+            if len(self._sub_cache) > self.SUBSCRIPTION_CACHE_SIZE:
+                self._sub_cache.popitem(last=False)
+        return time.time() < expiry
+
+    def _query_subscription(self, user_id: int) -> int:
+        # окончание подписки в секундах эпохи; 0 — подписки нет
+        with self.acquire_reader() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT subscription_end_ts FROM users WHERE id = ?', (user_id,))
+            row = cur.fetchone()
+        return (row and row['subscription_end_ts']) or 0
 
     # reminders
-    def add_reminder(self, user_id: int, chat_id: int, text: str, due_iso: str) -> int:
-        cur = self.conn.cursor()
+    def add_reminder(self, user_id: int, chat_id: int, text: str, due_ts: int) -> int:
+        return self.add_reminders([(user_id, chat_id, text, due_ts)])[0]
+
+    def add_reminders(self, rows: List[tuple]) -> List[int]:
+        # вся пачка — одна транзакция и один commit: (user_id, chat_id, text, due_ts);
+        # execute в цикле, а не executemany, потому что нужны id каждой строки
         now = datetime.utcnow().replace(microsecond=0).isoformat()
-        cur.execute('''INSERT INTO reminders (user_id, chat_id, text, due_date, created_at) VALUES (?, ?, ?, ?, ?)''',
-                    (user_id, chat_id, text, due_iso, now))
-        self.conn.commit()
-        return cur.lastrowid
-
-    def get_reminders(self, user_id: int) -> List[sqlite3.Row]:
-        cur = self.conn.cursor()
-        cur.execute('SELECT * FROM reminders WHERE user_id = ? ORDER BY due_date', (user_id,))
-        return cur.fetchall()
-
-    def get_future_reminders(self) -> List[sqlite3.Row]:
-        cur = self.conn.cursor()
-        cur.execute('SELECT * FROM reminders WHERE completed = 0')
-        return cur.fetchall()
-
-    def mark_reminder_completed(self, reminder_id: int):
-        cur = self.conn.cursor()
-        cur.execute('UPDATE reminders SET completed = 1 WHERE id = ?', (reminder_id,))
-        self.conn.commit()
+        with self.connection() as conn:
+            cur = conn.cursor()
+            ids = []
+            for user_id, chat_id, text, due_ts in rows:
+                cur.execute(SQL_INSERT_REMINDER, (user_id, chat_id, text, due_ts, now))
+                ids.append(cur.lastrowid)
+            return ids
+
+    def get_reminders_for_display(self, user_id: int) -> List[tuple]:
+        # для вывода списка: только нужные столбцы и обычные кортежи (completed, text, due_ts) без обёртки Row
+        with self.acquire_reader() as conn:
+            cur = conn.cursor()
+            cur.row_factory = None
+            cur.execute(SQL_REMINDERS_FOR_DISPLAY, (user_id,))
+            return cur.fetchall()
+
+    def get_pending_reminders_between(self, start_ts: int, end_ts: int) -> List[tuple]:
+        # диапазон [start_ts, end_ts) — скан частичного индекса idx_reminders_pending; нужны только (due_ts, id)
+        with self.acquire_reader() as conn:
+            cur = conn.cursor()
+            cur.row_factory = None
+            cur.execute(SQL_PENDING_REMINDERS_BETWEEN, (start_ts, end_ts))
+            return cur.fetchall()
+
+    # Захват напоминаний перед отправкой: UPDATE ... RETURNING атомарно отмечает строки и возвращает их,
+    # поэтому одно и то же напоминание не уйдёт дважды, даже если при перезапуске работают два процесса.
+    # Блокировку записи на время отправки не держим — неотправленные возвращаются release_reminders.
+    def claim_reminders(self, reminder_ids: List[int]) -> List[sqlite3.Row]:
+        # список id передаём одним JSON-параметром: текст запроса не зависит от размера пачки
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(SQL_CLAIM_REMINDERS, (json.dumps(reminder_ids),))
+            return cur.fetchall()
+
+    def claim_overdue_reminders(self, now_ts: int) -> List[sqlite3.Row]:
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(SQL_CLAIM_OVERDUE_REMINDERS, (now_ts,))
+            return cur.fetchall()
+
+    def release_reminders(self, reminder_ids: List[int]):
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.executemany(SQL_RELEASE_REMINDER, [(rem_id,) for rem_id in reminder_ids])
 
     # finance
-    def add_transaction(self, user_id: int, amount: str, category: str, description: str, ttype: str):
-        cur = self.conn.cursor()
+    def add_transaction(self, user_id: int, kopeks: int, category: str, description: str, ttype: str):
+        self.add_transactions_bulk([(user_id, kopeks, category, description, ttype)])
+
+    def add_transactions_bulk(self, rows: List[tuple]):
+        # вся пачка — одна транзакция и один commit: (user_id, kopeks, category, description, type)
         now = datetime.utcnow().replace(microsecond=0).isoformat()
-        cur.execute('INSERT INTO transactions (user_id, amount, category, description, type, created_at) VALUES (?, ?, ?, ?, ?, ?)',
-                    (user_id, amount, category, description, ttype, now))
-        self.conn.commit()
-
-    def get_financial_report(self, user_id: int) -> Dict[str, Decimal]:
-        cur = self.conn.cursor()
-        cur.execute('SELECT amount, type FROM transactions WHERE user_id = ?', (user_id,))
-        rows = cur.fetchall()
-        income = Decimal('0')
-        expense = Decimal('0')
-        for r in rows:
-            try:
-                amt = Decimal(r['amount'])
-            except Exception:
-                continue
-            if r['type'] == 'income':
-                income += amt
-            else:
-                expense += amt
+        params = []
+        totals: Dict[int, List[int]] = {}  # user_id -> [доход, расход] пачки в копейках
+        for user_id, kopeks, category, description, ttype in rows:
+            params.append((user_id, kopeks, category, description, ttype, now))
+            user_totals = totals.setdefault(user_id, [0, 0])
+            user_totals[0 if ttype == 'income' else 1] += kopeks
+        with self.connection() as conn:
+            conn.executemany(SQL_INSERT_TX, params)
+            conn.executemany(SQL_ADD_USER_TOTALS, [(user_id, income, expense) for user_id, (income, expense) in totals.items()])
+
+    def get_financial_report(self, user_id: int) -> Dict[str, int]:
+        # отчёт — чтение одной строки по первичному ключу, независимо от длины истории; суммы в копейках
+        with self.acquire_reader() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT income, expense FROM user_totals WHERE user_id = ?', (user_id,))
+            row = cur.fetchone()
+        income, expense = (row['income'], row['expense']) if row else (0, 0)
         return {'income': income, 'expense': expense, 'balance': income - expense}
 
+    # chat logs
+    def add_chat_logs(self, rows: List[tuple], keep: int):
+        # вся пачка — одна транзакция и одно подготовленное выражение: (user_id, chat_id, message, created_at)
+        # message_low заполняем здесь, чтобы при анализе настроения не приводить регистр заново
+        params = [(user_id, chat_id, message, message.lower(), created_at)
+                  for user_id, chat_id, message, created_at in rows]
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.executemany(SQL_INSERT_CHAT_LOG, params)
+            # хранение: у авторов пачки оставляем только последние keep сообщений — старше аналитика не читает
+            cur.executemany(SQL_TRIM_CHAT_LOGS, [(user_id, user_id, keep - 1) for user_id in {row[0] for row in rows}])
+
+    def get_analytics_bundle(self, user_id: int, limit: int, positive: tuple, negative: tuple) -> AnalyticsBundle:
+        # вся аналитика — один разбор, один план и одно чтение вместо отдельных запросов
+        with self.acquire_reader() as conn:
+            cur = conn.cursor()
+            cur.execute(_analytics_sql(len(positive), len(negative)), (*positive, *negative, user_id, limit, user_id))
+            row = cur.fetchone()
+        income, expense = row['income'], row['expense']
+        return AnalyticsBundle(total_messages=row['total'], positive=row['positive'], negative=row['negative'],
+                               mood=_classify_mood(row['positive'], row['negative']),
+                               income=income, expense=expense, balance=income - expense)
+
+# ---------- Асинхронный доступ к БД ----------
+class AsyncDatabase:
+    # sqlite3 синхронный: каждый запрос уходит в поток, цикл событий обслуживает других пользователей
+    def __init__(self, db: Database):
+        self.sync = db
+        # не больше запросов в полёте, чем соединений в пуле: остальные ждут в цикле событий,
+        # а не занимают потоки исполнителя в ожидании свободного соединения
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def _run(self, func, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.sync.POOL_SIZE)
+        async with self._semaphore:
+            return await asyncio.to_thread(func, *args)
+
+    async def add_user(self, user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str]):
+        await self._run(self.sync.add_user, user_id, username, first_name, last_name)
+
+    async def count_users(self) -> int:
+        return await self._run(self.sync.count_users)
+
+    async def count_active_subscriptions(self) -> int:
+        return await self._run(self.sync.count_active_subscriptions)
+
+    async def claim_trial(self, user_id: int, days: int) -> Optional[int]:
+        return await self._run(self.sync.claim_trial, user_id, days)
+
+    async def credit_payment(self, payment_id: str, user_id: int, days: int) -> bool:
+        return await self._run(self.sync.credit_payment, payment_id, user_id, days)
+
+    async def get_subscription_end(self, user_id: int) -> int:
+        return await self._run(self.sync.get_subscription_end, user_id)
+
+    async def check_subscription(self, user_id: int) -> bool:
+        return await self._run(self.sync.check_subscription, user_id)
+
+    # reminders
+    async def add_reminder(self, user_id: int, chat_id: int, text: str, due_ts: int) -> int:
+        return await self._run(self.sync.add_reminder, user_id, chat_id, text, due_ts)
+
+    async def get_reminders_for_display(self, user_id: int) -> List[tuple]:
+        return await self._run(self.sync.get_reminders_for_display, user_id)
+
+    async def get_pending_reminders_between(self, start_ts: int, end_ts: int) -> List[tuple]:
+        return await self._run(self.sync.get_pending_reminders_between, start_ts, end_ts)
+
+    async def claim_reminders(self, reminder_ids: List[int]) -> List[sqlite3.Row]:
+        return await self._run(self.sync.claim_reminders, reminder_ids)
+
+    async def claim_overdue_reminders(self, now_ts: int) -> List[sqlite3.Row]:
+        return await self._run(self.sync.claim_overdue_reminders, now_ts)
+
+    async def release_reminders(self, reminder_ids: List[int]):
+        await self._run(self.sync.release_reminders, reminder_ids)
+
+    # finance
+    async def add_transaction(self, user_id: int, kopeks: int, category: str, description: str, ttype: str):
+        await self._run(self.sync.add_transaction, user_id, kopeks, category, description, ttype)
+
+    async def get_financial_report(self, user_id: int) -> Dict[str, int]:
+        return await self._run(self.sync.get_financial_report, user_id)
+
+    # chat logs
+    async def add_chat_logs(self, rows: List[tuple], keep: int):
+        await self._run(self.sync.add_chat_logs, rows, keep)
+
+    async def get_analytics_bundle(self, user_id: int, limit: int, positive: tuple, negative: tuple) -> AnalyticsBundle:
+        return await self._run(self.sync.get_analytics_bundle, user_id, limit, positive, negative)
+
+    def close(self):
+        self.sync.close()
+
 # ---------- ReminderManager ----------
 class ReminderManager:
-    def __init__(self, db: Database):
+    # в памяти держим только напоминания ближайших часов; остальные подгружаются повторным сканом
+    HORIZON = int(os.getenv('REMINDER_HORIZON_HOURS', '24')) * 3600  # сек
+    DISPLAY_CACHE_TTL = 30  # сек
+    DISPLAY_CACHE_SIZE = 1000
+    ERROR_RETRY_DELAY = 30  # сек: пауза перед повтором после ошибки БД или отправки
+    MAX_SEND_ATTEMPTS = 3   # после стольких неудачных отправок напоминание ждёт перезапуска
+    SEND_CONCURRENCY = 30   # Telegram пропускает около 30 сообщений в секунду на бота
+    MESSAGE_LIMIT = 4096    # максимальная длина текста сообщения
+
+    def __init__(self, db: AsyncDatabase):
+        # все запросы — через AsyncDatabase: ни один не блокирует цикл событий,
+        # а число одновременных ограничено вместе с остальными обработчиками
         self.db = db
-        self.scheduled_jobs = {}  # reminder_id -> job
-
-    def schedule_all(self, job_queue):
-        # восстанавливаем отложенные задачи
-        reminders = self.db.get_future_reminders()
-        for rem in reminders:
-            if rem['completed']:
-                continue
+        # одна фоновая задача спит до ближайшего срока вместо отдельного таймера на каждое напоминание
+        self._heap: List[tuple] = []  # (due_ts, reminder_id)
+        self._horizon = 0  # всё, что раньше этого момента, уже загружено в кучу
+        self._wake: Optional[asyncio.Event] = None
+        self._dispatcher_task: Optional[asyncio.Task] = None
+        self._send_semaphore: Optional[asyncio.Semaphore] = None
+        self._send_attempts: Dict[int, int] = {}  # reminder_id -> неудачных отправок подряд
+        self._bot = None
+        # user_id -> (monotonic-время чтения, список для /reminders); трогается только из цикла событий,
+        # сбрасывается при добавлении и отправке напоминаний пользователя
+        self._display_cache: 'OrderedDict[int, tuple]' = OrderedDict()
+
+    def start(self, bot):
+        # вызывается из post_init, когда цикл событий уже запущен
+        self._bot = bot
+        self._wake = asyncio.Event()
+        self._send_semaphore = asyncio.Semaphore(self.SEND_CONCURRENCY)
+        self._dispatcher_task = asyncio.create_task(self._dispatcher())
+        self._dispatcher_task.add_done_callback(self._on_dispatcher_done)
+
+    @staticmethod
+    def _on_dispatcher_done(task: asyncio.Task):
+        # цикл диспетчера сам перехватывает ошибки; сюда попадаем, только если он всё-таки упал
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Диспетчер напоминаний остановился', exc_info=task.exception())
+
+    async def stop(self):
+        if self._dispatcher_task:
+            self._dispatcher_task.cancel()
+            try:
+                await self._dispatcher_task
+            except asyncio.CancelledError:
+                pass
+
+    async def schedule_all(self, now_ts: int, horizon_ts: int) -> (List[tuple], List[tuple]):
+        # напоминания до горизонта и просроченные за время простоя
+        pending = await self.db.get_pending_reminders_between(now_ts, horizon_ts)
+        overdue = [(rem['id'], rem['user_id'], rem['chat_id'], rem['text'])
+                   for rem in await self.db.claim_overdue_reminders(now_ts)]
+        return pending, overdue
+
+    def _push_all(self, pending: List[tuple]):
+        # пачку со скана добавляем одним heapify за O(n) вместо heappush на каждую строку
+        self._heap.extend(pending)
+        heapq.heapify(self._heap)
+        logger.debug('Scheduled %s reminders', len(pending))
+
+    async def _rescan(self):
+        # горизонт сдвигаем до запроса: add_reminder, пришедший во время скана, положит своё напоминание сам
+        start_ts, self._horizon = self._horizon, int(time.time()) + self.HORIZON
+        try:
+            self._push_all(await self.db.get_pending_reminders_between(start_ts, self._horizon))
+        except Exception:
+            # диапазон перечитаем при следующем скане; дубликаты в куче отбросит захват
+            self._horizon = start_ts
+            raise
+
+    async def _load(self):
+        now_ts = int(time.time())
+        self._horizon = now_ts + self.HORIZON
+        pending, overdue = await self.schedule_all(now_ts, self._horizon)
+        self._push_all(pending)
+        if overdue:
+            await self._send_batch(overdue)
+
+    async def _dispatcher(self):
+        # ошибка БД или отправки не должна останавливать единственную задачу: логируем и продолжаем
+        while True:
             try:
-                due = datetime.fromisoformat(rem['due_date'])
+                await self._load()
+                break
             except Exception:
+                logger.exception('Не удалось загрузить напоминания, повтор через %d с', self.ERROR_RETRY_DELAY)
+                await asyncio.sleep(self.ERROR_RETRY_DELAY)
+        next_rescan = time.time() + self.HORIZON / 2
+        while True:
+            now = time.time()
+            if now >= next_rescan:
+                try:
+                    await self._rescan()
+                    next_rescan = now + self.HORIZON / 2
+                except Exception:
+                    logger.exception('Не удалось обновить очередь напоминаний')
+                    next_rescan = now + self.ERROR_RETRY_DELAY
                 continue
-            seconds = (due - datetime.utcnow()).total_seconds()
-            if seconds <= 0:
-                # просрочено — отправим немедленно через очередь
-                seconds = 1
-            job = job_queue.run_once(self._job_callback, seconds, data={'reminder_id': rem['id']})
-            self.scheduled_jobs[rem['id']] = job
-            logger.debug(f'Scheduled reminder {rem["id"]} in {seconds} seconds')
-
-    async def _job_callback(self, context: ContextTypes.DEFAULT_TYPE):
-        data = context.job.data
-        rem_id = data.get('reminder_id')
-        cur = self.db.conn.cursor()
-        cur.execute('SELECT * FROM reminders WHERE id = ?', (rem_id,))
-        rem = cur.fetchone()
-        if not rem or rem['completed']:
-            return
-        chat_id = rem['chat_id']
-        text = rem['text']
-        try:
-            await context.bot.send_message(chat_id=chat_id, text=f'🔔 Напоминание: {text}')
-            self.db.mark_reminder_completed(rem_id)
-            logger.info(f'Reminder {rem_id} sent to chat {chat_id}')
-        except Exception as e:
-            logger.exception(f'Не удалось отправить напоминание {rem_id}: {e}')
-
-    def add_reminder(self, user_id: int, chat_id: int, text: str, due_iso: str, job_queue) -> (bool, str):
-        # проверка формата даты
+            timeout = next_rescan - now
+            if self._heap:
+                if self._heap[0][0] <= now:
+                    # всё, что наступило к этому моменту, отправляем одной пачкой
+                    due_ids = []
+                    while self._heap and self._heap[0][0] <= now:
+                        due_ids.append(heapq.heappop(self._heap)[1])
+                    try:
+                        await self._send_due(due_ids)
+                    except Exception:
+                        # незахваченные напоминания остались в БД невыполненными — вернём их в кучу с паузой
+                        logger.exception('Не удалось отправить напоминания %s', due_ids)
+                        retry_ts = now + self.ERROR_RETRY_DELAY
+                        for rem_id in due_ids:
+                            heapq.heappush(self._heap, (retry_ts, rem_id))
+                    continue
+                timeout = min(timeout, self._heap[0][0] - now)
+            # add_reminder будит задачу, если новый срок раньше текущего ожидания
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send_due(self, rem_ids: List[int]):
+        # один захват на пачку; уже выполненные (например, дубликаты в куче) в результат не попадут
+        rows = await self.db.claim_reminders(rem_ids)
+        await self._send_batch([(rem['id'], rem['user_id'], rem['chat_id'], rem['text']) for rem in rows])
+
+    async def _send_batch(self, reminders: List[tuple]):
+        # напоминания уже захвачены (completed = 1). Всё, что не ушло — ошибка отправки или отмена задачи
+        # при остановке, — в finally снова становится невыполненным: доставка не теряется.
+        # сработавшие одновременно напоминания одного чата уходят одним сообщением, чаты — параллельно
+        by_chat: Dict[int, List[tuple]] = {}
+        for rem_id, _user_id, chat_id, text in reminders:
+            by_chat.setdefault(chat_id, []).append((rem_id, text))
+        sent = set()
         try:
-            due = datetime.fromisoformat(due_iso)
-        except Exception:
-            return False, 'Неверный формат даты. Используйте: YYYY-MM-DD HH:MM'
-        if due < datetime.utcnow():
+            await asyncio.gather(*(self._send_chat(chat_id, items, sent) for chat_id, items in by_chat.items()))
+        finally:
+            unsent = [rem_id for rem_id, _user_id, _chat_id, _text in reminders if rem_id not in sent]
+            if unsent:
+                await self.db.release_reminders(unsent)
+            # списки сбрасываем после release: иначе в кэш мог бы попасть промежуточный статус
+            for _rem_id, user_id, _chat_id, _text in reminders:
+                self._display_cache.pop(user_id, None)
+        for rem_id in sent:
+            self._send_attempts.pop(rem_id, None)
+        self._retry_later(unsent)
+        logger.info('Sent %s reminders', len(sent))
+
+    def _retry_later(self, rem_ids: List[int]):
+        # освобождённые напоминания уже ниже горизонта, скан их не вернёт — кладём в кучу сами, с паузой
+        retry_ts = time.time() + self.ERROR_RETRY_DELAY
+        for rem_id in rem_ids:
+            attempts = self._send_attempts.get(rem_id, 0) + 1
+            if attempts >= self.MAX_SEND_ATTEMPTS:
+                self._send_attempts.pop(rem_id, None)
+                logger.warning('Напоминание %s не отправлено после %d попыток, повтор после перезапуска', rem_id, attempts)
+                continue
+            self._send_attempts[rem_id] = attempts
+            heapq.heappush(self._heap, (retry_ts, rem_id))
+
+    async def _send_chat(self, chat_id: int, items: List[tuple], sent: set):
+        # id успешно отправленных добавляются в sent сразу после каждого сообщения
+        for chunk in self._pack_messages(items):
+            if len(chunk) == 1:
+                text = f'🔔 Напоминание: {chunk[0][1]}'
+            else:
+                text = '🔔 Напоминания:\n\n' + '\n\n'.join(f'• {rem_text}' for _rem_id, rem_text in chunk)
+            rem_ids = [rem_id for rem_id, _rem_text in chunk]
+            try:
+                async with self._send_semaphore:
+                    await self._bot.send_message(chat_id=chat_id, text=text)
+            except Exception:
+                logger.exception('Не удалось отправить напоминания %s', rem_ids)
+                continue
+            sent.update(rem_ids)
+
+    def _pack_messages(self, items: List[tuple]) -> List[List[tuple]]:
+        # жадно складываем напоминания в сообщения, не превышая лимит длины Telegram
+        chunks, chunk, size = [], [], len('🔔 Напоминания:\n')
+        for rem_id, text in items:
+            item_size = len(text) + len('\n\n• ')
+            if chunk and size + item_size > self.MESSAGE_LIMIT:
+                chunks.append(chunk)
+                chunk, size = [], len('🔔 Напоминания:\n')
+            chunk.append((rem_id, text))
+            size += item_size
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    async def add_reminder(self, user_id: int, chat_id: int, text: str, due_ts: int) -> (bool, str):
+        if due_ts < time.time():
             return False, 'Дата в прошлом. Укажите будущую дату.'
-        rem_id = self.db.add_reminder(user_id, chat_id, text, due_iso)
-        seconds = (due - datetime.utcnow()).total_seconds()
-        job = job_queue.run_once(self._job_callback, seconds, data={'reminder_id': rem_id})
-        self.scheduled_jobs[rem_id] = job
+        rem_id = await self.db.add_reminder(user_id, chat_id, text, due_ts)
+        self._display_cache.pop(user_id, None)
+        # дальние напоминания подхватит очередной скан
+        if due_ts < self._horizon:
+            heapq.heappush(self._heap, (due_ts, rem_id))
+            if self._wake:
+                self._wake.set()
         return True, 'Напоминание создано и запланировано.'
 
-    def get_reminders(self, user_id: int):
-        return self.db.get_reminders(user_id)
+    async def get_reminders_for_display(self, user_id: int) -> List[tuple]:
+        now = time.monotonic()
+        cached = self._display_cache.get(user_id)
+        if cached and now < cached[0] + self.DISPLAY_CACHE_TTL:
+            self._display_cache.move_to_end(user_id)
+            return cached[1]
+        reminders = await self.db.get_reminders_for_display(user_id)
+        self._display_cache[user_id] = (now, reminders)
+        self._display_cache.move_to_end(user_id)
+        if len(self._display_cache) > self.DISPLAY_CACHE_SIZE:
+            self._display_cache.popitem(last=False)
+        return reminders
 
 # ---------- FinanceManager ----------
 class FinanceManager:
-    def __init__(self, db: Database):
+    def __init__(self, db: AsyncDatabase):
         self.db = db
 
-    def add_transaction(self, user_id: int, amount: Decimal, category: str, description: str, ttype: str):
-        # сохраняем строковое представление Decimal для безопасного хранения
-        self.db.add_transaction(user_id, str(amount), category, description, ttype)
+    async def add_transaction(self, user_id: int, amount: Decimal, category: str, description: str, ttype: str):
+        # Decimal нужен только для точного разбора ввода; дальше суммы — целые копейки
+        kopeks = _to_kopeks(amount)
+        # сумма, которая не переводится в копейки или не помещается в INTEGER SQLite, — ошибка формата ввода
+        if kopeks is None or abs(kopeks) >= 2 ** 63:
+            raise InvalidOperation(str(amount))
+        await self.db.add_transaction(user_id, kopeks, category, description, ttype)
 
-    def get_financial_report(self, user_id: int) -> Dict[str, Decimal]:
-        return self.db.get_financial_report(user_id)
+    async def get_financial_report(self, user_id: int) -> Dict[str, int]:
+        return await self.db.get_financial_report(user_id)
 
-# ---------- PaymentSystem (заглушка) ----------
+# ---------- PaymentSystem (ЮKassa) ----------
 class PaymentSystem:
-    def __init__(self):
-        # здесь можно интегрировать Yookassa / другие провайдеры
-        pass
+    API_URL = 'https://api.yookassa.ru'
+    RETRY_ATTEMPTS = 3
+    RETRY_BASE_DELAY = 0.2   # сек, удваивается с каждой попыткой
+    RETRY_MAX_DELAY = 2.0
+    IDEMPOTENCE_KEY_TTL = 3600  # сек: повторное нажатие в течение часа вернёт тот же платёж
+    IDEMPOTENCE_KEY_CACHE_SIZE = 10000
+    BREAKER_FAIL_MAX = 5        # столько сбоев подряд размыкают цепь
+    BREAKER_RESET_TIMEOUT = 30  # сек: через столько пропускаем один пробный запрос
 
-    def create_payment_link(self, user_id: int, amount_rub: int) -> str:
-        # возврат тестовой ссылки
-        return f'https://example.com/pay?user={user_id}&amount={amount_rub}'
+    def __init__(self):
+        self.shop_id = YOOKASSA_SHOP_ID
+        self.secret_key = YOOKASSA_SECRET_KEY
+        # ключи не меняются во время работы — заголовок авторизации кодируем один раз
+        self._auth_header = 'Basic ' + base64.b64encode(f'{self.shop_id}:{self.secret_key}'.encode()).decode()
+        # один клиент на всё время работы: keep-alive пул держит TLS-соединение с API тёплым
+        self._client: Optional[httpx.AsyncClient] = None
+        # user_id -> (Idempotence-Key, monotonic-время создания)
+        # порядок вставки совпадает с порядком создания, поэтому самые старые ключи всегда в начале
+        self._idempotence_keys: 'OrderedDict[int, tuple]' = OrderedDict()
+        # автомат защиты: пока ЮKassa лежит, обработчики получают отказ сразу, а не ждут таймаутов
+        self._failures = 0
+        self._opened_at = 0.0  # monotonic-время размыкания (или последнего пробного запроса)
+        # payment_id -> задача текущего запроса платежа
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.shop_id and self.secret_key)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # создаём лениво, уже внутри работающего цикла событий
+        if self._client is None:
+            # HTTP/2: параллельные создания и проверки платежей мультиплексируются в одном TLS-соединении;
+            # без пакета h2 httpx не умеет HTTP/2 — тогда остаёмся на пуле keep-alive соединений HTTP/1.1
+            self._client = httpx.AsyncClient(
+                base_url=self.API_URL,
+                http2=importlib.util.find_spec('h2') is not None,
+                timeout=httpx.Timeout(5.0, connect=2.0),
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+                headers={'Authorization': self._auth_header, 'Content-Type': 'application/json'},
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _idempotence_key(self, user_id: int) -> str:
+        # один ключ на попытку оплаты пользователя: и сетевые повторы, и повторное нажатие кнопки
+        # ЮKassa распознаёт как тот же запрос и не создаёт второй платёж
+        now = time.monotonic()
+        cached = self._idempotence_keys.get(user_id)
+        if cached and now < cached[1] + self.IDEMPOTENCE_KEY_TTL:
+            return cached[0]
+        key = str(uuid.uuid4())
+        self._idempotence_keys.pop(user_id, None)
+        self._idempotence_keys[user_id] = (key, now)
+        # выбрасываем истёкшие ключи с начала и держим размер в пределах лимита
+        while self._idempotence_keys:
+            _oldest_user, (_oldest_key, created) = next(iter(self._idempotence_keys.items()))
+            if now < created + self.IDEMPOTENCE_KEY_TTL and len(self._idempotence_keys) <= self.IDEMPOTENCE_KEY_CACHE_SIZE:
+                break
+            self._idempotence_keys.popitem(last=False)
+        return key
+
+    def forget_key(self, user_id: int):
+        # платёж завершён (оплачен или отменён): следующая оплата должна создать новый платёж,
+        # а не получить от ЮKassa прежний по тому же ключу
+        self._idempotence_keys.pop(user_id, None)
+
+    def _breaker_allows(self) -> bool:
+        if self._failures < self.BREAKER_FAIL_MAX:
+            return True
+        # цепь разомкнута: раз в BREAKER_RESET_TIMEOUT пропускаем пробный запрос, остальным — отказ
+        now = time.monotonic()
+        if now >= self._opened_at + self.BREAKER_RESET_TIMEOUT:
+            self._opened_at = now
+            return True
+        return False
+
+    def _on_outage(self, reason: str) -> None:
+        self._failures += 1
+        if self._failures == self.BREAKER_FAIL_MAX:
+            self._opened_at = time.monotonic()
+            logger.error('ЮKassa недоступна (%s), запросы приостановлены на %d с', reason, self.BREAKER_RESET_TIMEOUT)
+        else:
+            logger.warning('ЮKassa недоступна (%s)', reason)
+        return None
+
+    def _parse(self, response: httpx.Response) -> Optional[Dict[str, Any]]:
+        # 5xx — сбой на стороне ЮKassa; 4xx означает, что сервис отвечает, и остаётся ошибкой запроса
+        if response.status_code >= 500:
+            return self._on_outage(f'HTTP {response.status_code}')
+        self._failures = 0
+        response.raise_for_status()
+        return orjson.loads(response.content) if orjson else response.json()
+
+    async def create_payment(self, user_id: int, amount_rub: int) -> Optional[Dict[str, Any]]:
+        # None — ЮKassa недоступна или цепь разомкнута
+        if not self._breaker_allows():
+            return None
+        payload = {
+            'amount': {'value': f'{amount_rub}.00', 'currency': 'RUB'},
+            'capture': True,
+            'confirmation': {'type': 'redirect', 'return_url': YOOKASSA_RETURN_URL},
+            'description': f'Подписка для пользователя {user_id}',
+            # значения metadata в API ЮKassa — строки; belongs_to сравнивает с той же строкой
+            'metadata': {'user_id': str(user_id)},
+        }
+        headers = {'Idempotence-Key': self._idempotence_key(user_id)}
+        # тело сериализуем один раз на все попытки; Content-Type задан в заголовках клиента
+        body = orjson.dumps(payload) if orjson else json.dumps(payload).encode()
+        # с ключом идемпотентности повтор безопасен: сбой соединения или таймаут чтения повторяем с паузой
+        for attempt in range(self.RETRY_ATTEMPTS):
+            try:
+                response = await self._get_client().post('/v3/payments', content=body, headers=headers)
+                break
+            except (httpx.ConnectError, httpx.ReadTimeout) as e:
+                if attempt == self.RETRY_ATTEMPTS - 1:
+                    return self._on_outage(type(e).__name__)
+                delay = min(self.RETRY_BASE_DELAY * 2 ** attempt, self.RETRY_MAX_DELAY)
+                logger.warning('ЮKassa недоступна (%s), повтор через %.1f с', type(e).__name__, delay)
+                await asyncio.sleep(delay)
+            except httpx.TransportError as e:
+                return self._on_outage(type(e).__name__)
+        return self._parse(response)
+
+    async def get_payment(self, payment_id: str) -> Optional[Dict[str, Any]]:
+        # одновременные проверки одного платежа ждут один и тот же запрос к API;
+        # shield — отмена одного ожидающего не отменяет запрос для остальных
+        task = self._inflight.get(payment_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch_payment(payment_id))
+            self._inflight[payment_id] = task
+            task.add_done_callback(lambda done: self._forget_inflight(payment_id, done))
+        return await asyncio.shield(task)
+
+    def _forget_inflight(self, payment_id: str, task: asyncio.Task):
+        self._inflight.pop(payment_id, None)
+        # забираем исключение, даже если все ожидающие уже отменены: иначе asyncio пишет
+        # 'Task exception was never retrieved'; сами ожидающие получают его через shield
+        if not task.cancelled():
+            task.exception()
+
+    async def _fetch_payment(self, payment_id: str) -> Optional[Dict[str, Any]]:
+        if not self._breaker_allows():
+            return None
+        try:
+            response = await self._get_client().get(f'/v3/payments/{payment_id}')
+        except httpx.TransportError as e:
+            return self._on_outage(type(e).__name__)
+        return self._parse(response)
+
+    async def create_payment_link(self, user_id: int, amount_rub: int) -> Optional[tuple]:
+        # (ссылка на оплату, id платежа для проверки); None — ЮKassa недоступна
+        if not self.enabled:
+            # ключи не заданы — тестовая ссылка, проверять нечего
+            return f'https://example.com/pay?user={user_id}&amount={amount_rub}', None
+        try:
+            payment = await self.create_payment(user_id, amount_rub)
+        except httpx.HTTPStatusError:
+            # 4xx: ЮKassa отвергла запрос — пользователю отвечаем, а не молчим
+            logger.exception('ЮKassa отклонила создание платежа для пользователя %s', user_id)
+            return None
+        if payment is None:
+            return None
+        logger.info('Payment %s created for user %s', payment['id'], user_id)
+        return payment['confirmation']['confirmation_url'], payment['id']
+
+    @staticmethod
+    def belongs_to(payment: Dict[str, Any], user_id: int) -> bool:
+        # metadata ЮKassa возвращает строками; чужой платёж подписку не продлевает
+        return payment.get('metadata', {}).get('user_id') == str(user_id)
 
 # ---------- ChatMonitor (простая аналитика настроения) ----------
 class ChatMonitor:
-    POSITIVE = {'спасибо', 'отлично', 'класс', 'хорошо', 'супер', 'рад', 'люблю'}
-    NEGATIVE = {'плохо', 'ужасно', 'ненавижу', 'грустно', 'печаль', 'злой'}
-
-    def __init__(self, db: Database):
+    POSITIVE = frozenset({'спасибо', 'отлично', 'класс', 'хорошо', 'супер', 'рад', 'люблю'})
+    NEGATIVE = frozenset({'плохо', 'ужасно', 'ненавижу', 'грустно', 'печаль', 'злой'})
+    # фиксированный порядок слов — текст запроса не меняется и берётся из кэша выражений sqlite3
+    POSITIVE_WORDS = tuple(sorted(POSITIVE))
+    NEGATIVE_WORDS = tuple(sorted(NEGATIVE))
+    ANALYSIS_WINDOW = 100  # сколько последних сообщений анализируем
+
+    QUEUE_SIZE = 1000     # ограничение очереди: сверх него сообщения не копятся в памяти
+    BULK_SIZE = 200       # максимум строк в одном INSERT
+    FLUSH_TIMEOUT = 0.1   # сек: сколько ждём добора пачки после первого сообщения
+
+    def __init__(self, db: AsyncDatabase):
         self.db = db
-        # для простоты мы не сохраняем сообщения, только считаем при запросе
-        # реальная реализация может хранить сообщения и считать статистику
+        # сообщения копятся в очереди и пишутся в БД пачками фоновой задачей
+        self._queue: Optional[asyncio.Queue] = None
+        self._flusher_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        # вызывается из post_init, когда цикл событий уже запущен
+        self._queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        self._flusher_task = asyncio.create_task(self._flusher())
+
+    async def stop(self):
+        # не отменяем задачу (она могла держать уже вынутую пачку), а ставим в конец очереди метку:
+        # flusher допишет всё, что было до неё, и завершится сам
+        if self._flusher_task:
+            await self._queue.put(None)
+            await self._flusher_task
 
     def log_message(self, user_id: int, chat_id: int, message: str):
-        # в простом варианте логируем в stdout; при необходимости можно сохранить в БД
-        logger.debug(f'Log message from {user_id} in {chat_id}: {message[:200]}')
+        # не ждём места в очереди: при переполнении сообщение не попадёт в аналитику, но ответ не задержится
+        logger.debug('Log message from %s in %s: %.200s', user_id, chat_id, message)
+        now = datetime.utcnow().replace(microsecond=0).isoformat()
+        try:
+            self._queue.put_nowait((user_id, chat_id, message, now))
+        except asyncio.QueueFull:
+            logger.warning('Очередь журнала сообщений переполнена, сообщение от %s пропущено', user_id)
+
+    async def _flusher(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.FLUSH_TIMEOUT
+            while len(batch) < self.BULK_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+
+    async def _write(self, batch: List[tuple]):
+        try:
+            await self.db.add_chat_logs(batch, self.ANALYSIS_WINDOW)
+        except Exception:
+            logger.exception('Не удалось сохранить %d сообщений', len(batch))
 
-    def analyze_chat_mood(self, user_id: int) -> Dict[str, Any]:
-        # возврат фиктивной аналитики (на базе последних N сообщений можно расширить)
-        # Для демонстрации вернём нулевые значения
-        return {'total_messages': 0, 'positive': 0, 'negative': 0, 'mood': 'neutral'}
+    async def get_analytics(self, user_id: int) -> AnalyticsBundle:
+        return await self.db.get_analytics_bundle(user_id, self.ANALYSIS_WINDOW, self.POSITIVE_WORDS, self.NEGATIVE_WORDS)
 
 # ---------- Утилиты ----------
-import telegram.helpers as helpers
+# таблица экранирования MarkdownV2 строится один раз; str.translate проходит строку за один C-цикл
+_MARKDOWN_V2_ESCAPES = str.maketrans({ch: '\\' + ch for ch in '\\_*[]()~`>#+-=|{}.!'})
 
 def safe_markdown(text: str) -> str:
-    try:
-        return helpers.escape_markdown(text, version=2)
-    except Exception:
-        # fallback: простая замена
-        return text.replace('_', '\_').replace('*', '\*')
+    return text.translate(_MARKDOWN_V2_ESCAPES)
+
+def format_ts(ts: Optional[int]) -> str:
+    # секунды эпохи -> 'YYYY-MM-DD HH:MM' (UTC)
+    if ts is None:
+        return '?'
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%d %H:%M')
+
+# ---------- Шаблоны сообщений ----------
+MONEY_FIELDS = ('income', 'expense', 'balance')
+
+def format_rubles(kopeks: int) -> str:
+    # целые копейки -> '-9.10' без перехода к float
+    rubles, rest = divmod(abs(kopeks), 100)
+    return f'{"-" if kopeks < 0 else ""}{rubles}.{rest:02d}'
+
+def in_rubles(values: Dict[str, Any]) -> Dict[str, Any]:
+    # суммы хранятся в копейках; в рубли переводим только при выводе в шаблон
+    return {**values, **{field: format_rubles(values[field]) for field in MONEY_FIELDS}}
+
+FINANCE_REPORT_TEXT = (
+    '💰 Финансовый отчет:\n\n'
+    '💵 Доходы: {income}₽\n'
+    '💸 Расходы: {expense}₽\n'
+    '📊 Баланс: {balance}₽'
+)
+FINANCE_MENU_TEXT = (
+    '💰 Финансовый отчет\n\n'
+    '💵 Доходы: {income}₽\n'
+    '💸 Расходы: {expense}₽\n'
+    '📊 Баланс: {balance}₽\n\n'
+    'Чтобы добавить транзакцию используйте /finance [сумма] [income/expense] [категория]'
+)
+ANALYTICS_REPORT_TEXT = (
+    '📊 Аналитика вашей активности:\n\n'
+    '💬 Сообщений проанализировано: {total_messages}\n'
+    '😊 Позитивных сообщений: {positive}\n'
+    '😔 Негативных сообщений: {negative}\n'
+    '📈 Настроение: {mood}\n\n'
+    '💰 Финансы:\n'
+    '• Доходы: {income}₽\n'
+    '• Расходы: {expense}₽\n'
+    '• Баланс: {balance}₽'
+)
+ANALYTICS_MENU_TEXT = (
+    '📊 Аналитика вашей активности\n\n'
+    '💬 Сообщений: {total_messages}\n'
+    '😊 Позитивных: {positive}\n'
+    '😔 Негативных: {negative}\n'
+    '📈 Настроение: {mood}\n\n'
+    '💰 Финансы:\n'
+    '• Доходы: {income}₽\n'
+    '• Расходы: {expense}₽\n'
+    '• Баланс: {balance}₽'
+)
+ADMIN_PANEL_TEXT = (
+    '👑 *Панель администратора*\n\n'
+    '👥 Всего пользователей: {total_users}\n'
+    '💳 Активных подписок: {active_subscriptions}\n\n'
+    'Для настройки ЮKassa добавьте в .env: YOOKASSA_SHOP_ID и YOOKASSA_SECRET_KEY'
+)
+PAYMENT_UNAVAILABLE_TEXT = '⚠️ Платёжная система временно недоступна. Попробуйте позже.'
+
+# бот обрабатывает только сообщения и нажатия кнопок — остальные типы обновлений Telegram не присылает
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# одно регулярное выражение вместо поиска каждого слова отдельно; регистр учитывает сам re
+GREETING_RE = re.compile(r'\b(?:привет|hello|hi)\b', re.IGNORECASE)
+
+# ---------- Клавиатуры ----------
+# статичные клавиатуры собираются один раз при импорте и переиспользуются во всех ответах
+_SECTION_BUTTONS = [
+    [InlineKeyboardButton('📅 Напоминания', callback_data='reminders_btn')],
+    [InlineKeyboardButton('💰 Финансы', callback_data='finance_btn')],
+    [InlineKeyboardButton('📊 Аналитика', callback_data='analytics_btn')],
+]
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton('💳 Купить подписку', callback_data='subscribe_btn')]] + _SECTION_BUTTONS
+)
+SECTIONS_KEYBOARD = InlineKeyboardMarkup(_SECTION_BUTTONS)
+SUBSCRIPTION_REQUIRED_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton('💳 Получить подписку', callback_data='subscribe_btn')],
+    [InlineKeyboardButton('🔙 Назад', callback_data='back_to_main')],
+])
+BACK_TO_MAIN_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton('🔙 Главное меню', callback_data='back_to_main')]])
+
+
+def payment_keyboard(payment_link: str, payment_id: Optional[str] = None) -> InlineKeyboardMarkup:
+    # меняются ссылка и id платежа, поэтому клавиатуру оплаты собираем на каждый ответ
+    buttons = [[InlineKeyboardButton('💳 Оплатить', url=payment_link)]]
+    if payment_id:
+        buttons.append([InlineKeyboardButton('✅ Я оплатил', callback_data=f'check_payment:{payment_id}')])
+    return InlineKeyboardMarkup(buttons)
 
 # ---------- Бот ----------
 class LifeAssistantBot:
+    __slots__ = ('db', 'payment_system', 'reminder_manager', 'finance_manager', 'chat_monitor', 'application')
+
     def __init__(self):
         logger.info('Initializing bot...')
-        self.db = Database()
+        self.db = AsyncDatabase(Database())
         self.payment_system = PaymentSystem()
         self.reminder_manager = ReminderManager(self.db)
         self.finance_manager = FinanceManager(self.db)
         self.chat_monitor = ChatMonitor(self.db)
 
-        self.application = Application.builder().token(TELEGRAM_TOKEN).build()
+        self.application = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
         self.setup_handlers()
 
+    async def post_init(self, application: Application):
+        self.chat_monitor.start()
+        self.reminder_manager.start(application.bot)
+
+    async def post_shutdown(self, application: Application):
+        await self.reminder_manager.stop()
+        await self.chat_monitor.stop()
+        await self.payment_system.close()
+        self.db.close()
+
     def setup_handlers(self):
         self.application.add_handler(CommandHandler('start', self.start))
         self.application.add_handler(CommandHandler('help', self.help_command))
@@ -309,8 +1305,19 @@ class LifeAssistantBot:
         self.application.add_handler(CommandHandler('analytics', self.analytics))
         self.application.add_handler(CommandHandler('admin', self.admin))
 
-        # CallbackQueryHandler
-        self.application.add_handler(CallbackQueryHandler(self.handle_button))
+        # CallbackQueryHandler: маршрутизация по callback_data выполняется самим PTB
+        button_routes = {
+            '^subscribe_btn$': self.process_subscription_button,
+            '^reminders_btn$': self.process_reminders_button,
+            '^finance_btn$': self.process_finance_button,
+            '^analytics_btn$': self.process_analytics_button,
+            '^back_to_main$': self.show_main_menu,
+            '^check_payment:': self.process_check_payment_button,
+        }
+        for pattern, callback in button_routes.items():
+            self.application.add_handler(CallbackQueryHandler(self._button(callback), pattern=pattern, block=False))
+        # всё, что не совпало ни с одним шаблоном
+        self.application.add_handler(CallbackQueryHandler(self.handle_unknown_button))
 
         # Messages
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
@@ -329,7 +1336,6 @@ class LifeAssistantBot:
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        self.db.add_user(user.id, user.username, user.first_name, user.last_name)
 
         welcome_text = (
             f"👋 Привет, {safe_markdown(user.first_name or '')}!\n\n"
@@ -340,15 +1346,11 @@ class LifeAssistantBot:
             "Для доступа ко всем функциям нужна подписка.\n"
         )
 
-        keyboard = [
-            [InlineKeyboardButton('💳 Купить подписку', callback_data='subscribe_btn')],
-            [InlineKeyboardButton('📅 Напоминания', callback_data='reminders_btn')],
-            [InlineKeyboardButton('💰 Финансы', callback_data='finance_btn')],
-            [InlineKeyboardButton('📊 Аналитика', callback_data='analytics_btn')],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        await update.message.reply_text(welcome_text, reply_markup=reply_markup, parse_mode='MarkdownV2')
+        await update.message.reply_text(welcome_text, reply_markup=MAIN_MENU_KEYBOARD, parse_mode='MarkdownV2')
+        # запись пользователя в БД не задерживает приветствие; ошибки уйдут в error_handler
+        context.application.create_task(
+            self.db.add_user(user.id, user.username, user.first_name, user.last_name), update=update
+        )
 
     async def subscribe(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         await self.process_subscription(update, context)
@@ -368,19 +1370,12 @@ class LifeAssistantBot:
             await update.message.reply_text('❌ У вас нет прав администратора')
             return
 
-        cur = self.db.conn.cursor()
-        cur.execute('SELECT COUNT(*) as count FROM users')
-        total_users = cur.fetchone()['count']
-        # count active subscriptions
-        cur.execute('SELECT COUNT(*) as count FROM users WHERE subscription_end > ?', (datetime.utcnow().isoformat(),))
-        active_subscriptions = cur.fetchone()['count']
-
-        text = (
-            f'👑 *Панель администратора*\n\n'
-            f'👥 Всего пользователей: {total_users}\n'
-            f'💳 Активных подписок: {active_subscriptions}\n\n'
-            'Для настройки ЮKassa добавьте в .env: YOOKASSA_SHOP_ID и YOOKASSA_SECRET_KEY'
+        total_users, active_subscriptions = await asyncio.gather(
+            self.db.count_users(),
+            self.db.count_active_subscriptions(),
         )
+
+        text = ADMIN_PANEL_TEXT.format_map({'total_users': total_users, 'active_subscriptions': active_subscriptions})
         await update.message.reply_text(text, parse_mode='MarkdownV2')
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -389,57 +1384,45 @@ class LifeAssistantBot:
         self.chat_monitor.log_message(user.id, update.effective_chat.id, message)
 
         # простые приветствия
-        if any(word in message.lower() for word in ['привет', 'hello', 'hi']):
+        if GREETING_RE.search(message):
             await update.message.reply_text(f'👋 Привет, {safe_markdown(user.first_name or "")}! Используй /start для начала работы.', parse_mode='MarkdownV2')
 
-    async def handle_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    def _button(self, callback):
+        async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            query = update.callback_query
+            await query.answer()
+            logger.info('Button pressed: %s by user %s', query.data, query.from_user.id)
+            await callback(query, context)
+        return handler
+
+    async def handle_unknown_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()
-        data = query.data
-        user_id = query.from_user.id
-        logger.info(f'Button pressed: {data} by user {user_id}')
-
-        if data == 'subscribe_btn':
-            await self.process_subscription_button(query, context)
-        elif data == 'reminders_btn':
-            await self.process_reminders_button(query, context)
-        elif data == 'finance_btn':
-            await self.process_finance_button(query, context)
-        elif data == 'analytics_btn':
-            await self.process_analytics_button(query, context)
-        elif data == 'back_to_main':
-            await self.show_main_menu(query)
-        else:
-            # fallback
-            if query.message:
-                await query.message.edit_text(f'❌ Неизвестная команда: {data}')
+        logger.info('Unknown button: %s by user %s', query.data, query.from_user.id)
+        if query.message:
+            await query.message.edit_text(f'❌ Неизвестная команда: {query.data}')
 
     # ----- Команды (реализация) -----
     async def process_subscription(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        if self.db.check_subscription(user_id) or (ADMIN_ID and user_id == ADMIN_ID):
+        if await self.db.check_subscription(user_id):
             await update.message.reply_text('✅ У вас уже есть активная подписка!')
             return
         # выдаём однократный trial
-        if not self.db.check_trial_used(user_id):
-            self.db.update_subscription(user_id, days=TRIAL_DAYS)
-            self.db.set_trial_used(user_id)
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton('📅 Напоминания', callback_data='reminders_btn')],
-                [InlineKeyboardButton('💰 Финансы', callback_data='finance_btn')],
-                [InlineKeyboardButton('📊 Аналитика', callback_data='analytics_btn')],
-            ])
-            await update.message.reply_text('🎉 Тестовый доступ активирован на %d дней!' % TRIAL_DAYS, reply_markup=keyboard)
+        if await self.db.claim_trial(user_id, days=TRIAL_DAYS):
+            await update.message.reply_text('🎉 Тестовый доступ активирован на %d дней!' % TRIAL_DAYS, reply_markup=SECTIONS_KEYBOARD)
             return
         else:
             # если trial уже использован, предлагаем оплату
-            payment_link = self.payment_system.create_payment_link(user_id, 500)
-            keyboard = InlineKeyboardMarkup([[InlineKeyboardButton('💳 Оплатить', url=payment_link)]])
-            await update.message.reply_text('У вас уже был использован тестовый период. Оплатите подписку для продолжения.', reply_markup=keyboard)
+            payment = await self.payment_system.create_payment_link(user_id, SUBSCRIPTION_PRICE_RUB)
+            if payment is None:
+                await update.message.reply_text(PAYMENT_UNAVAILABLE_TEXT)
+                return
+            await update.message.reply_text('У вас уже был использован тестовый период. Оплатите подписку для продолжения.', reply_markup=payment_keyboard(*payment))
 
     async def process_reminders(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        if not self.db.check_subscription(user_id) and (ADMIN_ID is None or user_id != ADMIN_ID):
+        if not await self.db.check_subscription(user_id):
             await update.message.reply_text('❌ Для доступа к напоминаниям нужна подписка! Используйте /subscribe')
             return
         # если есть аргументы — добавляем
@@ -451,50 +1434,51 @@ class LifeAssistantBot:
                 # присоединяем последние два токена как дату и время
                 date_time_str = ' '.join(context.args[-2:])
                 text = ' '.join(context.args[:-2])
-                # приводим к ISO-like: 'YYYY-MM-DD HH:MM' -> 'YYYY-MM-DDTHH:MM:00' для fromisoformat
+                # 'YYYY-MM-DD HH:MM' (UTC, если смещение не указано) -> секунды эпохи;
+                # fromisoformat разбирает фиксированный формат в C, без интерпретации шаблона strptime
                 try:
-                    due = datetime.strptime(date_time_str, '%Y-%m-%d %H:%M')
-                    due_iso = due.replace(microsecond=0).isoformat()
+                    due = datetime.fromisoformat(date_time_str)
+                    if due.tzinfo is None:
+                        due = due.replace(tzinfo=timezone.utc)
+                    due_ts = int(due.timestamp())
                 except ValueError:
                     await update.message.reply_text('Неверный формат даты. Используйте: YYYY-MM-DD HH:MM')
                     return
-                success, message = self.reminder_manager.add_reminder(user_id, update.effective_chat.id, text, due_iso, self.application.job_queue)
+                success, message = await self.reminder_manager.add_reminder(user_id, update.effective_chat.id, text, due_ts)
                 await update.message.reply_text(message)
             except Exception as e:
                 logger.exception('Ошибка при добавлении напоминания')
                 await update.message.reply_text(f'Ошибка: {e}')
         else:
-            reminders = self.reminder_manager.get_reminders(user_id)
+            reminders = await self.reminder_manager.get_reminders_for_display(user_id)
             if not reminders:
                 await update.message.reply_text('📝 У вас нет активных напоминаний')
                 return
             text_lines = ['📅 Ваши напоминания:\n']
-            for rem in reminders:
-                status = '✅' if rem['completed'] else '⏳'
-                # форматим дату красиво
-                try:
-                    due = datetime.fromisoformat(rem['due_date']).strftime('%Y-%m-%d %H:%M')
-                except Exception:
-                    due = rem['due_date']
-                text_lines.append(f"{status} {safe_markdown(rem['text'])} - {due}")
+            for completed, text, due_ts in reminders:
+                status = '✅' if completed else '⏳'
+                text_lines.append(f'{status} {safe_markdown(text)} - {format_ts(due_ts)}')
             await update.message.reply_text('\n'.join(text_lines), parse_mode='MarkdownV2')
 
     async def process_finance(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        if not self.db.check_subscription(user_id) and (ADMIN_ID is None or user_id != ADMIN_ID):
+        if not await self.db.check_subscription(user_id):
             await update.message.reply_text('❌ Для доступа к финансового учета нужна подписка! Используйте /subscribe')
             return
         if context.args and len(context.args) >= 3:
             try:
                 raw_amount = context.args[0].replace(',', '.')
                 amount = Decimal(raw_amount)
+                if not amount.is_finite():
+                    # NaN и Infinity Decimal принимает, но в копейки они не переводятся
+                    raise InvalidOperation(raw_amount)
                 transaction_type = context.args[1].lower()
                 category = context.args[2]
                 description = ' '.join(context.args[3:]) if len(context.args) > 3 else ''
                 if transaction_type not in ['income', 'expense']:
                     await update.message.reply_text("Тип должен быть 'income' или 'expense'")
                     return
-                self.finance_manager.add_transaction(user_id, amount, category, description, transaction_type)
+                await self.finance_manager.add_transaction(user_id, amount, category, description, transaction_type)
                 await update.message.reply_text('✅ Транзакция добавлена!')
             except InvalidOperation:
                 await update.message.reply_text('Неверный формат суммы. Пример использования: /finance 1500 expense продукты')
@@ -502,120 +1486,100 @@ class LifeAssistantBot:
                 logger.exception('Ошибка при добавлении транзакции')
                 await update.message.reply_text('Ошибка при добавлении транзакции')
         else:
-            report = self.finance_manager.get_financial_report(user_id)
-            text = (
-                f"💰 Финансовый отчет:\n\n"
-                f"💵 Доходы: {report['income']:.2f}₽\n"
-                f"💸 Расходы: {report['expense']:.2f}₽\n"
-                f"📊 Баланс: {report['balance']:.2f}₽"
-            )
+            report = await self.finance_manager.get_financial_report(user_id)
+            text = FINANCE_REPORT_TEXT.format_map(in_rubles(report))
             await update.message.reply_text(text)
 
     async def process_analytics(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        if not self.db.check_subscription(user_id) and (ADMIN_ID is None or user_id != ADMIN_ID):
+        if not await self.db.check_subscription(user_id):
             await update.message.reply_text('❌ Для доступа к аналитике нужна подписка! Используйте /subscribe')
             return
-        chat_analysis = self.chat_monitor.analyze_chat_mood(user_id)
-        finance_report = self.finance_manager.get_financial_report(user_id)
-        text = (
-            '📊 Аналитика вашей активности:\n\n'
-            f"💬 Сообщений проанализировано: {chat_analysis['total_messages']}\n"
-            f"😊 Позитивных сообщений: {chat_analysis['positive']}\n"
-            f"😔 Негативных сообщений: {chat_analysis['negative']}\n"
-            f"📈 Настроение: {chat_analysis['mood']}\n\n"
-            '💰 Финансы:\n'
-            f"• Доходы: {finance_report['income']:.2f}₽\n"
-            f"• Расходы: {finance_report['expense']:.2f}₽\n"
-            f"• Баланс: {finance_report['balance']:.2f}₽"
-        )
+        analytics = await self.chat_monitor.get_analytics(user_id)
+        text = ANALYTICS_REPORT_TEXT.format_map(in_rubles(asdict(analytics)))
         await update.message.reply_text(text)
 
     # ----- Кнопки -----
     async def process_subscription_button(self, query, context):
         user_id = query.from_user.id
-        if self.db.check_subscription(user_id) or (ADMIN_ID and user_id == ADMIN_ID):
+        if await self.db.check_subscription(user_id):
             await query.message.edit_text('✅ Подписка активна. Выберите раздел:')
             return
         # Trial
-        if not self.db.check_trial_used(user_id):
-            self.db.update_subscription(user_id, days=TRIAL_DAYS)
-            self.db.set_trial_used(user_id)
+        if await self.db.claim_trial(user_id, days=TRIAL_DAYS):
             await query.message.edit_text('🎉 Тестовый доступ активирован!')
             return
-        payment_link = self.payment_system.create_payment_link(user_id, 500)
-        await query.message.edit_text('Оплатите подписку: ' + payment_link)
+        payment = await self.payment_system.create_payment_link(user_id, SUBSCRIPTION_PRICE_RUB)
+        if payment is None:
+            await query.message.edit_text(PAYMENT_UNAVAILABLE_TEXT, reply_markup=BACK_TO_MAIN_KEYBOARD)
+            return
+        await query.message.edit_text('Оплатите подписку, затем нажмите «Я оплатил».', reply_markup=payment_keyboard(*payment))
+
+    async def process_check_payment_button(self, query, context):
+        user_id = query.from_user.id
+        payment_id = query.data.split(':', 1)[1]
+        try:
+            payment = await self.payment_system.get_payment(payment_id)
+        except httpx.HTTPStatusError:
+            logger.exception('ЮKassa отклонила запрос платежа %s', payment_id)
+            payment = None
+        if payment is None:
+            await query.message.reply_text(PAYMENT_UNAVAILABLE_TEXT)
+            return
+        if not self.payment_system.belongs_to(payment, user_id):
+            await query.message.edit_text('❌ Платёж не найден.')
+            return
+        if payment['status'] in ('succeeded', 'canceled'):
+            self.payment_system.forget_key(user_id)
+        if payment['status'] == 'succeeded':
+            # повторное нажатие не продлевает подписку второй раз: платёж зачитывается один раз
+            await self.db.credit_payment(payment_id, user_id, SUBSCRIPTION_DAYS)
+            end_ts = await self.db.get_subscription_end(user_id)
+            await query.message.edit_text(f'✅ Оплата получена. Подписка активна до {format_ts(end_ts)} (UTC).',
+                                          reply_markup=SECTIONS_KEYBOARD)
+        elif payment['status'] == 'canceled':
+            await query.message.edit_text('❌ Платёж отменён. Оформите подписку заново: /subscribe')
+        else:
+            await query.message.reply_text('⏳ Оплата ещё не поступила. Нажмите «Я оплатил» после оплаты.')
 
     async def process_reminders_button(self, query, context):
         user_id = query.from_user.id
-        if not self.db.check_subscription(user_id) and (ADMIN_ID is None or user_id != ADMIN_ID):
-            await query.message.edit_text('❌ Для доступа к напоминаниям нужна подписка.', reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton('💳 Получить подписку', callback_data='subscribe_btn')],
-                [InlineKeyboardButton('🔙 Назад', callback_data='back_to_main')]
-            ]))
+        if not await self.db.check_subscription(user_id):
+            await query.message.edit_text('❌ Для доступа к напоминаниям нужна подписка.', reply_markup=SUBSCRIPTION_REQUIRED_KEYBOARD)
             return
-        reminders = self.reminder_manager.get_reminders(user_id)
+        reminders = await self.reminder_manager.get_reminders_for_display(user_id)
         if not reminders:
             text = '📝 Управление напоминаниями\n\nУ вас пока нет напоминаний. Чтобы добавить, используйте /reminders Текст 2025-01-01 12:00'
         else:
             lines = ['📝 Ваши напоминания:']
-            for r in reminders:
-                status = '✅' if r['completed'] else '⏳'
-                try:
-                    due = datetime.fromisoformat(r['due_date']).strftime('%Y-%m-%d %H:%M')
-                except Exception:
-                    due = r['due_date']
-                lines.append(f"{status} {safe_markdown(r['text'])} - {due}")
+            for completed, text, due_ts in reminders:
+                status = '✅' if completed else '⏳'
+                lines.append(f'{status} {safe_markdown(text)} - {format_ts(due_ts)}')
             text = '\n'.join(lines)
-        await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton('🔙 Главное меню', callback_data='back_to_main')]]), parse_mode='MarkdownV2')
+        await query.message.edit_text(text, reply_markup=BACK_TO_MAIN_KEYBOARD, parse_mode='MarkdownV2')
 
     async def process_finance_button(self, query, context):
         user_id = query.from_user.id
-        if not self.db.check_subscription(user_id) and (ADMIN_ID is None or user_id != ADMIN_ID):
-            await query.message.edit_text('❌ Для доступа к финансам нужна подписка.', reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton('💳 Получить подписку', callback_data='subscribe_btn')],
-                [InlineKeyboardButton('🔙 Назад', callback_data='back_to_main')],
-            ]))
+        if not await self.db.check_subscription(user_id):
+            await query.message.edit_text('❌ Для доступа к финансам нужна подписка.', reply_markup=SUBSCRIPTION_REQUIRED_KEYBOARD)
             return
-        report = self.finance_manager.get_financial_report(user_id)
-        text = (
-            f'💰 Финансовый отчет\n\n💵 Доходы: {report["income"]:.2f}₽\n💸 Расходы: {report["expense"]:.2f}₽\n📊 Баланс: {report["balance"]:.2f}₽\n\nЧтобы добавить транзакцию используйте /finance [сумма] [income/expense] [категория]'
-        )
-        await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton('🔙 Главное меню', callback_data='back_to_main')]]))
+        report = await self.finance_manager.get_financial_report(user_id)
+        text = FINANCE_MENU_TEXT.format_map(in_rubles(report))
+        await query.message.edit_text(text, reply_markup=BACK_TO_MAIN_KEYBOARD)
 
     async def process_analytics_button(self, query, context):
         user_id = query.from_user.id
-        if not self.db.check_subscription(user_id) and (ADMIN_ID is None or user_id != ADMIN_ID):
-            await query.message.edit_text('❌ Для доступа к аналитике нужна подписка.', reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton('💳 Получить подписку', callback_data='subscribe_btn')],
-                [InlineKeyboardButton('🔙 Назад', callback_data='back_to_main')],
-            ]))
+        if not await self.db.check_subscription(user_id):
+            await query.message.edit_text('❌ Для доступа к аналитике нужна подписка.', reply_markup=SUBSCRIPTION_REQUIRED_KEYBOARD)
             return
-        chat_analysis = self.chat_monitor.analyze_chat_mood(user_id)
-        finance_report = self.finance_manager.get_financial_report(user_id)
-        text = (
-            '📊 Аналитика вашей активности\n\n'
-            f'💬 Сообщений: {chat_analysis["total_messages"]}\n'
-            f'😊 Позитивных: {chat_analysis["positive"]}\n'
-            f'😔 Негативных: {chat_analysis["negative"]}\n'
-            f'📈 Настроение: {chat_analysis["mood"]}\n\n'
-            '💰 Финансы:\n'
-            f'• Доходы: {finance_report["income"]:.2f}₽\n'
-            f'• Расходы: {finance_report["expense"]:.2f}₽\n'
-            f'• Баланс: {finance_report["balance"]:.2f}₽'
-        )
-        await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton('🔙 Главное меню', callback_data='back_to_main')]]))
+        analytics = await self.chat_monitor.get_analytics(user_id)
+        text = ANALYTICS_MENU_TEXT.format_map(in_rubles(asdict(analytics)))
+        await query.message.edit_text(text, reply_markup=BACK_TO_MAIN_KEYBOARD)
 
-    async def show_main_menu(self, query):
+    async def show_main_menu(self, query, context):
         user = query.from_user
         welcome_text = f'👋 С возвращением, {safe_markdown(user.first_name or "")}!\n\nВыберите нужный раздел:'
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton('💳 Купить подписку', callback_data='subscribe_btn')],
-            [InlineKeyboardButton('📅 Напоминания', callback_data='reminders_btn')],
-            [InlineKeyboardButton('💰 Финансы', callback_data='finance_btn')],
-            [InlineKeyboardButton('📊 Аналитика', callback_data='analytics_btn')],
-        ])
-        await query.message.edit_text(welcome_text, reply_markup=keyboard, parse_mode='MarkdownV2')
+        await query.message.edit_text(welcome_text, reply_markup=MAIN_MENU_KEYBOARD, parse_mode='MarkdownV2')
 
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         help_text = (
@@ -635,14 +1599,32 @@ class LifeAssistantBot:
         await update.message.reply_text(help_text, parse_mode='MarkdownV2')
 
     def run(self):
-        # восстановим задачи напоминаний после старта
-        logger.info('Scheduling existing reminders...')
-        self.reminder_manager.schedule_all(self.application.job_queue)
-        logger.info('Starting polling...')
+        # напоминания восстанавливает диспетчер ReminderManager, запускаемый в post_init
         try:
-            self.application.run_polling()
-        except Exception as e:
+            if WEBHOOK_DOMAIN:
+                logger.info('Starting webhook...')
+                self.application.run_webhook(
+                    listen='0.0.0.0',
+                    port=WEBHOOK_PORT,
+                    url_path=TELEGRAM_TOKEN,
+                    webhook_url=f'https://{WEBHOOK_DOMAIN}/{TELEGRAM_TOKEN}',
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=ALLOWED_UPDATES,
+                )
+            else:
+                logger.info('Starting polling...')
+                # long polling: getUpdates висит на стороне Telegram до 30 с, пока не придёт обновление,
+                # вместо частых пустых запросов; при сетевых сбоях на старте повторяем без ограничения
+                self.application.run_polling(
+                    timeout=30,
+                    poll_interval=0.0,
+                    bootstrap_retries=-1,
+                    allowed_updates=ALLOWED_UPDATES,
+                )
+        except Exception:
             logger.exception('Bot stopped with error')
+        finally:
+            log_listener.stop()
 
 
 if __name__ == '__main__':